@@ -1,9 +1,25 @@
-from typing import List, Tuple, Dict
+import functools
+import heapq
+import math
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Dict, Optional
+import numpy as np
 from tqdm import tqdm
 from .ByteTokenizer import ByteTokenizer
 from .ByteTokenizer import merge
-from .ByteTokenizer import count_pairs
+from .ByteTokenizer import count_pairs_parallel
+from .ByteTokenizer import unpack_pair
+from .ByteTokenizer import pretokenize
+from .ByteTokenizer import build_linked_list
+from .ByteTokenizer import group_positions
+from .ByteTokenizer import merge_positions
+from ._bpe_core import NUMBA_AVAILABLE
+from ._bpe_core import count_pairs_nb
 
+# Сколько закодированных кусков текста хранит кэш encode
+ENCODE_CACHE_SIZE = 100_000
 
 
 class BpeTokenizer(ByteTokenizer):
@@ -23,11 +39,12 @@ class BpeTokenizer(ByteTokenizer):
     -------
     init_vocab() -> None
         Переинициализирует словарь, добавляя таблицу склеиваний BPE.
-    train(texts: List[str], max_vocab: int) -> None
+    train(texts: List[str], max_vocab: int, n_jobs: Optional[int] = None) -> None
         Тренирует BPE-токенизатор, находя наиболее частотные пары токенов и склеивая их,
         пока не будет достигнут заданный размер словаря.
     encode(text: str) -> List[int]
-        Преобразует строку в список байтов с применением BPE для наиболее частотных пар токенов.
+        Преобразует строку в список байтов, применяя склеивания BPE в порядке их появления при обучении.
+        Результаты для отдельных кусков текста кэшируются.
     """
     def __init__(self):
         """
@@ -44,8 +61,21 @@ class BpeTokenizer(ByteTokenizer):
         """
         super().init_vocab()
         self.merges = {}
+        # Кэш создаётся заново вместе с таблицей склеиваний, чтобы не отдавать результаты старого словаря
+        self._encode_chunk_cached = functools.lru_cache(maxsize=ENCODE_CACHE_SIZE)(self._encode_chunk)
 
-    def train(self, texts: List[str], max_vocab: int) -> None:
+    def __getstate__(self) -> dict:
+        """Возвращает состояние для pickle без кэша encode (он не сериализуется и пересоздаётся при загрузке)."""
+        state = self.__dict__.copy()
+        del state['_encode_chunk_cached']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        """Восстанавливает состояние из pickle и создаёт пустой кэш encode."""
+        self.__dict__.update(state)
+        self._encode_chunk_cached = functools.lru_cache(maxsize=ENCODE_CACHE_SIZE)(self._encode_chunk)
+
+    def train(self, texts: List[str], max_vocab: int, n_jobs: Optional[int] = None) -> None:
         """
         Тренирует BPE-токенизатор на предоставленных текстах, последовательно склеивая
         наиболее частотные пары токенов до достижения заданного размера словаря.
@@ -56,6 +86,8 @@ class BpeTokenizer(ByteTokenizer):
             Список текстов для тренировки токенизатора.
         max_vocab : int
             Максимальный размер словаря, после достижения которого процесс тренировки остановится.
+        n_jobs : Optional[int], по умолчанию None
+            Число потоков для подсчёта и склеивания пар. По умолчанию равно числу ядер процессора.
 
         Возвращает:
         -----------
@@ -67,30 +99,70 @@ class BpeTokenizer(ByteTokenizer):
             return
         progress_bar = tqdm(range(max_vocab - len(self.vocab)))
 
-        # Формируем исходный список номеров токенов для каждого текста (изначально это байты в кодировке utf-8)
-        list_of_ids = [list(text.encode('utf-8')) for text in texts]
-        print(list_of_ids)
-        for _ in progress_bar:
-            # Находим наиболее частотную пару токенов для склеивания в один токен
-            cnt = count_pairs(list_of_ids)
-            pair = max(cnt, key=cnt.get)
-            freq = cnt[pair]
-            progress_bar.set_description(f'pair={pair}, freq={freq}')
-
-            if freq == 1:
-                break
-
-            new_idx = len(self.vocab)
-            self.merges[pair] = new_idx
-            self.vocab[new_idx] = self.vocab[pair[0]] + self.vocab[pair[1]]
-
-            for i, ids in enumerate(list_of_ids):
-                list_of_ids[i] = merge(ids, pair, new_idx)
+        # Разбиваем тексты на куски (слова, числа, пробелы) и оставляем только уникальные куски с их частотой:
+        # одинаковые куски склеиваются одинаково, поэтому достаточно обработать каждый один раз с весом
+        chunk_freq = Counter(chunk.encode('utf-8') for text in texts for chunk in pretokenize(text))
+
+        # Корпус хранится одним буфером номеров токенов (изначально это байты в кодировке utf-8) с границами кусков
+        chunks = list(chunk_freq)
+        lengths = np.fromiter(map(len, chunks), dtype=np.int64, count=len(chunks))
+        offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        ids = np.frombuffer(b''.join(chunks), dtype=np.uint8).astype(np.int32)
+        weights = np.fromiter(chunk_freq.values(), dtype=np.int64, count=len(chunks))
+
+        # Частоты пар считаются один раз, дальше они обновляются только в местах склеивания.
+        # Корпус хранится как двусвязный список, чтобы удаление склеенного элемента стоило O(1)
+        n_jobs = n_jobs or os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            if NUMBA_AVAILABLE:
+                keys, counts = count_pairs_nb(ids, offsets, weights)
+            else:
+                keys, counts = count_pairs_parallel(np.split(ids, offsets[1:-1]), weights, executor, n_jobs)
+            pair_counts = dict(zip(keys.tolist(), counts.tolist()))
+            prev_pos, next_pos = build_linked_list(offsets)
+            position_weights = np.repeat(weights, lengths)
+            pair_positions = group_positions(ids, next_pos)
+            heap = [(-freq, key) for key, freq in pair_counts.items()]
+            heapq.heapify(heap)
+
+            # Без Numba ядро склеивания держит GIL, и потоки не дают выигрыша
+            merge_executor = executor if NUMBA_AVAILABLE else None
+
+            for _ in progress_bar:
+                # Находим наиболее частотную пару токенов для склеивания в один токен,
+                # пропуская устаревшие записи кучи, частота которых уже изменилась
+                while heap and pair_counts.get(heap[0][1]) != -heap[0][0]:
+                    heapq.heappop(heap)
+                if not heap:
+                    break
+                freq, key = heapq.heappop(heap)
+                freq = -freq
+                pair = unpack_pair(key)
+                progress_bar.set_description(f'pair={pair}, freq={freq}')
+
+                if freq == 1:
+                    break
+
+                new_idx = len(self.vocab)
+                self.merges[pair] = new_idx
+                self.vocab.append(self.vocab[pair[0]] + self.vocab[pair[1]])
+
+                positions = np.unique(pair_positions.pop(key))
+                changed = merge_positions(
+                    ids, prev_pos, next_pos, positions, pair, new_idx, pair_counts, pair_positions,
+                    position_weights, offsets, merge_executor, n_jobs
+                )
+                for changed_key in changed:
+                    if changed_key in pair_counts:
+                        heapq.heappush(heap, (-pair_counts[changed_key], changed_key))
 
     def encode(self, text: str) -> List[int]:
         """
         Преобразует строку в последовательность идентификаторов с применением BPE.
 
+        Строка разбивается на куски так же, как при обучении, и каждый кусок кодируется отдельно;
+        результаты для повторяющихся кусков берутся из LRU-кэша.
+
         Параметры:
         ----------
         text : str
@@ -99,14 +171,34 @@ class BpeTokenizer(ByteTokenizer):
         Возвращает:
         -----------
         List[int]
-            Список идентификаторов с учётом частотных пар токенов, объединённых алгоритмом BPE.
+            Список идентификаторов с учётом пар токенов, объединённых алгоритмом BPE.
+        """
+        ids = []
+        for chunk in pretokenize(text):
+            ids.extend(self._encode_chunk_cached(chunk.encode('utf-8')))
+        return ids
+
+    def _encode_chunk(self, chunk: bytes) -> Tuple[int, ...]:
         """
-        ids = list(text.encode('utf-8'))
+        Применяет склеивания BPE к одному куску текста.
+
+        На каждом шаге склеивается пара с наименьшим рангом, то есть выученная раньше остальных.
+        Индексы новых токенов выдаются при обучении по возрастанию, поэтому рангом служит сам индекс из merges.
+
+        Параметры:
+        ----------
+        chunk : bytes
+            Кусок текста в кодировке utf-8.
+
+        Возвращает:
+        -----------
+        Tuple[int, ...]
+            Идентификаторы токенов куска.
+        """
+        ids = list(chunk)
         while len(ids) > 1:
-            cnt = count_pairs([ids])
-            pair = max(cnt, key=cnt.get)
-            if pair not in self.merges:
+            idx, pair = min((self.merges.get(pair, math.inf), pair) for pair in zip(ids, ids[1:]))
+            if idx == math.inf:
                 break
-            idx = self.merges[pair]
             ids = merge(ids, pair, idx)
-        return ids
+        return tuple(ids)
@@ -1,4 +1,30 @@
-from typing import List, Tuple, Dict
+import multiprocessing
+import os
+import re
+from concurrent.futures import Executor
+from typing import List, Tuple, Dict, Set, Optional
+
+import numpy as np
+from tqdm import tqdm
+
+from ._bpe_core import merge_nb
+
+# Разбиение текста на куски в духе GPT-2: сокращения, слова, числа, знаки препинания и пробелы.
+# Пробел перед словом остаётся частью слова, поэтому склеивания BPE не пересекают границы слов.
+PRETOKENIZE_PATTERN = re.compile(r"""'(?:[sdmt]|ll|ve|re)| ?[^\W\d_]+| ?\d+| ?(?:[^\s\w]|_)+|\s+(?!\S)|\s+""")
+
+# Число токенов-байтов: токены с номерами меньше этого значения декодируются в один байт, равный номеру
+N_BYTE_TOKENS = 256
+
+# Минимальное число позиций, начиная с которого склеивание пары раздаётся по потокам:
+# на меньших объёмах накладные расходы на запуск задач больше выигрыша
+PARALLEL_MIN_POSITIONS = 16384
+
+# Сколько текстов отправляется процессу-обработчику за раз в encode_batch
+ENCODE_BATCH_CHUNKSIZE = 64
+
+# Токенизатор процесса-обработчика encode_batch, задаётся при запуске процесса
+_worker_tokenizer = None
 
 
 class ByteTokenizer:
@@ -25,17 +51,20 @@ class ByteTokenizer:
         Идентификатор токена конца последовательности, назначается при инициализации словаря.
     special_tokens : List[bytes]
         Список специальных токенов, включающий pad_token, bos_token и eos_token.
-    vocab : dict
-        Словарь для сопоставления индексов и байтовых значений символов.
+    vocab : List[bytes]
+        Словарь токенов: элемент с индексом idx — байтовое представление токена idx.
 
     Методы:
     -------
     init_vocab() -> None
-        Инициализирует словарь (vocab), где ключами являются индексы, а значениями — байтовые представления символов.
+        Инициализирует словарь (vocab), где индексами являются номера токенов, а значениями — байтовые представления символов.
     train(texts: List[str], max_vocab: int) -> None
         Переинициализирует словарь (переопределяется в потомках).
     encode(text: str) -> List[int]
         Преобразует строку в список идентификаторов (байтов) с использованием кодировки UTF-8.
+    encode_batch(texts: List[str], n_jobs: Optional[int] = None) -> List[List[int]]
+        Преобразует список строк в списки идентификаторов, кодируя каждую уникальную строку один раз
+        и распределяя работу по процессам.
     decode(ids: List[int]) -> str
         Преобразует список идентификаторов (байтов) обратно в строку.
     get_vocab_size() -> int
@@ -49,16 +78,14 @@ class ByteTokenizer:
         self.bos_token_id = None
         self.eos_token_id = None
         self.special_tokens = [self.pad_token, self.bos_token, self.eos_token]
-        self.vocab = {}
+        self.vocab = []
         self.init_vocab()
 
     def init_vocab(self) -> None:
         """Инициализирует словарь для токенизации, добавляя байтовые представления символов и специальные токены."""
-        self.vocab = {idx: bytes([idx]) for idx in range(256)}
-        for token in self.special_tokens:
-            idx = len(self.vocab)
-            self.vocab[idx] = token
-        token_to_id = {y: x for x, y in self.vocab.items()}
+        # Номера токенов идут подряд с нуля, поэтому словарь хранится списком и индексируется напрямую
+        self.vocab = [bytes([idx]) for idx in range(N_BYTE_TOKENS)] + list(self.special_tokens)
+        token_to_id = {token: idx for idx, token in enumerate(self.vocab)}
         self.pad_token_id = token_to_id[self.pad_token]
         self.bos_token_id = token_to_id[self.bos_token]
         self.eos_token_id = token_to_id[self.eos_token]
@@ -82,6 +109,48 @@ class ByteTokenizer:
         """
         return list(text.encode('utf-8'))
 
+    def encode_batch(self, texts: List[str], n_jobs: Optional[int] = None) -> List[List[int]]:
+        """Преобразует список строк в списки идентификаторов.
+
+        Повторяющиеся строки кодируются один раз, а уникальные строки распределяются по процессам.
+        Процессы запускаются через fork, чтобы не перезапускать вызывающий скрипт; там, где fork
+        недоступен (Windows), кодирование выполняется в текущем процессе.
+
+        Параметры:
+        ----------
+        texts : List[str]
+            Список входных строк.
+        n_jobs : Optional[int], по умолчанию None
+            Число процессов. По умолчанию равно числу ядер процессора; при n_jobs=1 кодирование
+            выполняется в текущем процессе.
+
+        Возвращает:
+        -----------
+        List[List[int]]
+            Списки идентификаторов в порядке входных строк.
+        """
+        unique_texts = list(dict.fromkeys(texts))
+        n_jobs = n_jobs or os.cpu_count() or 1
+        progress_bar = tqdm(total=len(unique_texts))
+        # Со spawn каждый процесс заново импортировал бы вызывающий скрипт (Main.py выполняется на верхнем уровне модуля)
+        can_fork = 'fork' in multiprocessing.get_all_start_methods()
+        if n_jobs == 1 or not can_fork or len(unique_texts) <= ENCODE_BATCH_CHUNKSIZE:
+            encoded = []
+            for text in unique_texts:
+                encoded.append(self.encode(text))
+                progress_bar.update()
+        else:
+            context = multiprocessing.get_context('fork')
+            with context.Pool(n_jobs, initializer=_init_encode_worker, initargs=(self,)) as pool:
+                encoded = []
+                for ids in pool.imap(_encode_in_worker, unique_texts, chunksize=ENCODE_BATCH_CHUNKSIZE):
+                    encoded.append(ids)
+                    progress_bar.update()
+        progress_bar.close()
+
+        encoded = dict(zip(unique_texts, encoded))
+        return [list(encoded[text]) for text in texts]
+
     def decode(self, ids: List[int]) -> str:
         """Преобразует список идентификаторов обратно в строку.
 
@@ -95,6 +164,11 @@ class ByteTokenizer:
         str
             Декодированная строка.
         """
+        if isinstance(ids, np.ndarray):
+            ids = ids.tolist()
+        # Если все токены — отдельные байты, строка байтов собирается одним вызовом без обращений к словарю
+        if ids and max(ids) < N_BYTE_TOKENS:
+            return bytes(ids).decode('utf-8', errors='replace')
         text = b''.join(self.vocab[idx] for idx in ids).decode('utf-8', errors='replace')
         return text
 
@@ -109,34 +183,147 @@ class ByteTokenizer:
         return len(self.vocab)
 
 
-def count_pairs(data: List[List[int]]) -> Dict[Tuple[int, int], int]:
+def _init_encode_worker(tokenizer: ByteTokenizer) -> None:
+    """Запоминает токенизатор в процессе-обработчике encode_batch."""
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _encode_in_worker(text: str) -> List[int]:
+    """Кодирует строку токенизатором процесса-обработчика encode_batch."""
+    return _worker_tokenizer.encode(text)
+
+
+def unpack_pair(key: int) -> Tuple[int, int]:
+    """
+    Распаковывает ключ (a << 32) | b, полученный в count_pairs или group_positions, обратно в пару идентификаторов.
+
+    Параметры:
+    ----------
+    key : int
+        Упакованный ключ пары.
+
+    Возвращает:
+    -----------
+    Tuple[int, int]
+        Пара идентификаторов.
+    """
+    key = int(key)
+    return key >> 32, key & 0xFFFFFFFF
+
+
+def pretokenize(text: str) -> List[str]:
+    """
+    Разбивает текст на куски (слова, числа, знаки препинания, пробелы), внутри которых выполняется BPE.
+
+    Параметры:
+    ----------
+    text : str
+        Входная строка.
+
+    Возвращает:
+    -----------
+    List[str]
+        Список кусков, склейка которых даёт исходную строку.
+    """
+    return PRETOKENIZE_PATTERN.findall(text)
+
+
+def count_pairs(data: List[np.ndarray], weights: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
     """
     Считает, сколько раз встречается каждая пара последовательных элементов (стоящих на соседних позициях) во всех списках чисел.
 
+    Последовательности склеиваются в один массив через разделитель -1, соседние элементы упаковываются
+    в ключи uint64, а подсчёт выполняется одним вызовом np.unique. Пары, содержащие разделитель
+    (то есть пары на стыке двух последовательностей), отбрасываются.
+
     Параметры:
     ----------
-    data: List[List[int]]
-        Список, содержащий списки целых чисел.
+    data: List[np.ndarray]
+        Список массивов целых чисел (np.int32).
+    weights: Optional[np.ndarray], по умолчанию None
+        Веса последовательностей (например, сколько раз последовательность встретилась в корпусе).
+        Каждая пара учитывается с весом своей последовательности. По умолчанию все веса равны 1.
 
     Возвращает:
     -----------
-        Dict[Tuple[int, int], int]
-            Словарь, где ключами являются пары элементов (кортежи), а значениями - количество их появлений в списках.
+        Tuple[np.ndarray, np.ndarray]
+            Отсортированные упакованные ключи пар (uint64) и количество их появлений (int64).
+            Ключ распаковывается в пару функцией unpack_pair.
     """
-    Dict = {}
-    for i in data:
-        for j in range(len(i)-1):
-            if tuple([i[j], i[j+1]]) in Dict:
-                Dict[(i[j], i[j+1])] += 1
-            else:
-                Dict[(i[j], i[j+1])] = 1
-    return Dict
+    separator = np.array([-1], dtype=np.int64)
+    parts = []
+    for ids in data:
+        parts.append(np.asarray(ids, dtype=np.int64))
+        parts.append(separator)
+    if not parts:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+
+    flat = np.concatenate(parts)
+    left, right = flat[:-1], flat[1:]
+    valid = (left >= 0) & (right >= 0)
+    keys = (left[valid].astype(np.uint64) << np.uint64(32)) | right[valid].astype(np.uint64)
+    if weights is None:
+        keys, counts = np.unique(keys, return_counts=True)
+        return keys, counts.astype(np.int64)
+
+    lengths = np.array([len(ids) + 1 for ids in data], dtype=np.int64)
+    pair_weights = np.repeat(np.asarray(weights, dtype=np.int64), lengths)[:-1][valid]
+    keys, inverse = np.unique(keys, return_inverse=True)
+    counts = np.zeros(len(keys), dtype=np.int64)
+    np.add.at(counts, inverse, pair_weights)
+    return keys, counts
+
+
+def count_pairs_parallel(
+        data: List[np.ndarray],
+        weights: Optional[np.ndarray],
+        executor: Executor,
+        n_shards: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Считает частоты пар как count_pairs, разбивая список последовательностей на части и обрабатывая их параллельно.
+
+    Частичные результаты сводятся в один сложением частот по совпадающим ключам.
+
+    Параметры:
+    ----------
+    data: List[np.ndarray]
+        Список массивов целых чисел (np.int32).
+    weights: Optional[np.ndarray]
+        Веса последовательностей, None означает, что все веса равны 1.
+    executor : Executor
+        Пул, в котором выполняется подсчёт по частям.
+    n_shards : int
+        Число частей.
+
+    Возвращает:
+    -----------
+        Tuple[np.ndarray, np.ndarray]
+            Отсортированные упакованные ключи пар (uint64) и количество их появлений (int64).
+    """
+    if weights is None:
+        weights = np.ones(len(data), dtype=np.int64)
+    bounds = np.linspace(0, len(data), max(n_shards, 1) + 1).astype(np.int64)
+    shards = [(data[start:end], weights[start:end]) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+    results = list(executor.map(lambda shard: count_pairs(*shard), shards))
+    if not results:
+        return count_pairs([])
+
+    keys, inverse = np.unique(np.concatenate([keys for keys, _ in results]), return_inverse=True)
+    counts = np.zeros(len(keys), dtype=np.int64)
+    np.add.at(counts, inverse, np.concatenate([counts for _, counts in results]))
+    return keys, counts
 
 
 def merge(numbers: List[int], pair: Tuple[int, int], idx: int) -> List[int]:
     """
-    Двигаясь слева направо, заменяет все вхождения заданной пары чисел в массиве на заданный индекс.
-    Гарантируется, что заданный индекс не встречается в массиве чисел.
+    Двигаясь слева направо, заменяет все вхождения заданной пары чисел в списке на заданный индекс.
+    Гарантируется, что заданный индекс не встречается в списке чисел.
+
+    Вместо удаления элементов по одному (каждое удаление сдвигает хвост списка) новый список
+    собирается за один проход. Для пары из двух одинаковых чисел совпадения в цепочке вида a a a ...
+    перекрываются; проход слева направо склеивает первые два элемента и продолжает с третьего.
 
     Параметры:
     ----------
@@ -152,10 +339,207 @@ def merge(numbers: List[int], pair: Tuple[int, int], idx: int) -> List[int]:
     List[int]
         Новый список, где каждая найденная пара заменена на значение idx.
     """
+    merged = []
     i = 0
-    while i != len(numbers)-1:
-        if (numbers[i],numbers[i+1]) == pair:
-            numbers[i] = idx
-            del numbers[i+1]
-        i += 1
-    return numbers
+    while i < len(numbers):
+        if i + 1 < len(numbers) and numbers[i] == pair[0] and numbers[i + 1] == pair[1]:
+            merged.append(idx)
+            i += 2
+        else:
+            merged.append(numbers[i])
+            i += 1
+    return merged
+
+
+def build_linked_list(offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Строит двусвязный список соседей для корпуса, склеенного в один массив.
+
+    Удаление элемента из такого списка стоит O(1): достаточно перевесить ссылки соседей,
+    не сдвигая остальные элементы. На границах последовательностей ссылки равны -1.
+
+    Параметры:
+    ----------
+    offsets : np.ndarray
+        Границы последовательностей: i-я последовательность занимает позиции offsets[i]:offsets[i + 1].
+
+    Возвращает:
+    -----------
+    Tuple[np.ndarray, np.ndarray]
+        Индексы предыдущих и индексы следующих элементов (np.int32).
+    """
+    n = int(offsets[-1])
+    prev_pos = np.arange(-1, n - 1, dtype=np.int32)
+    next_pos = np.arange(1, n + 1, dtype=np.int32)
+
+    starts, ends = offsets[:-1], offsets[1:]
+    non_empty = ends > starts
+    prev_pos[starts[non_empty]] = -1
+    next_pos[ends[non_empty] - 1] = -1
+    return prev_pos, next_pos
+
+
+def group_by_key(keys: np.ndarray, values: np.ndarray) -> Dict[int, List[int]]:
+    """
+    Группирует значения по ключам, сохраняя исходный порядок значений внутри группы.
+
+    Параметры:
+    ----------
+    keys : np.ndarray
+        Ключи.
+    values : np.ndarray
+        Значения той же длины, что и ключи.
+
+    Возвращает:
+    -----------
+    Dict[int, List[int]]
+        Словарь, где каждому ключу соответствует список его значений.
+    """
+    order = np.argsort(keys, kind='stable')
+    unique_keys, starts = np.unique(keys[order], return_index=True)
+    groups = np.split(values[order], starts[1:])
+    return {key: group.tolist() for key, group in zip(unique_keys.tolist(), groups)}
+
+
+def group_positions(ids: np.ndarray, next_pos: np.ndarray) -> Dict[int, List[int]]:
+    """
+    Для каждой пары соседних элементов собирает позиции её левого элемента.
+
+    Параметры:
+    ----------
+    ids : np.ndarray
+        Склеенный массив идентификаторов.
+    next_pos : np.ndarray
+        Индексы следующих элементов из build_linked_list.
+
+    Возвращает:
+    -----------
+    Dict[int, List[int]]
+        Словарь, где ключами являются упакованные пары (см. unpack_pair), а значениями — позиции их вхождений.
+    """
+    left = np.flatnonzero(next_pos >= 0)
+    keys = (ids[left].astype(np.int64) << 32) | ids[next_pos[left]].astype(np.int64)
+    return group_by_key(keys, left)
+
+
+def split_positions(positions: np.ndarray, offsets: np.ndarray, n_shards: int) -> List[np.ndarray]:
+    """
+    Разбивает отсортированные позиции на части так, чтобы позиции одной последовательности попали в одну часть.
+
+    Склеивания в разных последовательностях не зависят друг от друга, поэтому такие части
+    можно обрабатывать параллельно.
+
+    Параметры:
+    ----------
+    positions : np.ndarray
+        Позиции, отсортированные по возрастанию.
+    offsets : np.ndarray
+        Границы последовательностей в склеенном массиве.
+    n_shards : int
+        Желаемое число частей.
+
+    Возвращает:
+    -----------
+    List[np.ndarray]
+        Непустые части позиций.
+    """
+    if n_shards <= 1 or len(positions) < n_shards:
+        return [positions]
+    cuts = positions[np.linspace(0, len(positions), n_shards + 1)[1:-1].astype(np.int64)]
+    # Переносим каждый разрез на начало последовательности, в которую он попал
+    sequence_starts = offsets[np.searchsorted(offsets, cuts, side='right') - 1]
+    split_indices = np.unique(np.searchsorted(positions, sequence_starts))
+    return [shard for shard in np.split(positions, split_indices) if len(shard)]
+
+
+def merge_positions(
+        ids: np.ndarray,
+        prev_pos: np.ndarray,
+        next_pos: np.ndarray,
+        positions: np.ndarray,
+        pair: Tuple[int, int],
+        idx: int,
+        pair_counts: Dict[int, int],
+        pair_positions: Dict[int, List[int]],
+        position_weights: Optional[np.ndarray] = None,
+        offsets: Optional[np.ndarray] = None,
+        executor: Optional[Executor] = None,
+        n_shards: int = 1
+) -> Set[int]:
+    """
+    Склеивает пару в указанных позициях двусвязного списка и обновляет частоты только соседних пар.
+
+    Для каждого вхождения x a b y пары (a, b) уменьшаются частоты (x, a), (a, b), (b, y) и увеличиваются
+    частоты (x, idx), (idx, y) на вес вхождения; позиции новых пар добавляются в pair_positions.
+    Сами склеивания выполняет ядро merge_nb, здесь его журнал изменений сворачивается в словари.
+    Если передан executor и позиций много, они разбиваются по последовательностям (см. split_positions)
+    и части склеиваются параллельно.
+
+    Параметры:
+    ----------
+    ids : np.ndarray
+        Склеенный массив идентификаторов, изменяется на месте.
+    prev_pos : np.ndarray
+        Индексы предыдущих элементов, изменяются на месте.
+    next_pos : np.ndarray
+        Индексы следующих элементов, изменяются на месте.
+    positions : np.ndarray
+        Позиции-кандидаты левого элемента пары, отсортированные по возрастанию.
+    pair : Tuple[int, int]
+        Пара целых чисел, которую необходимо склеить.
+    idx : int
+        Значение, на которое заменяется найденная пара.
+    pair_counts : Dict[int, int]
+        Частоты упакованных пар, изменяются на месте.
+    pair_positions : Dict[int, List[int]]
+        Позиции упакованных пар, дополняются на месте.
+    position_weights : Optional[np.ndarray], по умолчанию None
+        Вес каждой позиции склеенного массива (вес последовательности, которой она принадлежит).
+        По умолчанию все веса равны 1.
+    offsets : Optional[np.ndarray], по умолчанию None
+        Границы последовательностей в склеенном массиве, нужны для параллельного склеивания.
+    executor : Optional[Executor], по умолчанию None
+        Пул потоков для параллельного склеивания.
+    n_shards : int, по умолчанию 1
+        Число частей, на которые разбиваются позиции.
+
+    Возвращает:
+    -----------
+    Set[int]
+        Упакованные ключи пар, частоты которых изменились.
+    """
+    if position_weights is None:
+        position_weights = np.ones(len(ids), dtype=np.int64)
+    positions = np.asarray(positions, dtype=np.int64)
+    if executor is not None and offsets is not None and len(positions) >= PARALLEL_MIN_POSITIONS:
+        shards = split_positions(positions, offsets, n_shards)
+    else:
+        shards = [positions]
+
+    def merge_shard(shard: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return merge_nb(ids, prev_pos, next_pos, shard, pair[0], pair[1], idx, position_weights)
+
+    if len(shards) > 1:
+        logs = list(executor.map(merge_shard, shards))
+        keys, deltas, new_positions = (np.concatenate(parts) for parts in zip(*logs))
+    else:
+        keys, deltas, new_positions = merge_shard(shards[0])
+
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    totals = np.zeros(len(unique_keys), dtype=np.int64)
+    np.add.at(totals, inverse, deltas)
+    changed = set()
+    for key, delta in zip(unique_keys.tolist(), totals.tolist()):
+        if delta == 0:
+            continue
+        count = pair_counts.get(key, 0) + delta
+        if count:
+            pair_counts[key] = count
+        else:
+            pair_counts.pop(key, None)
+        changed.add(key)
+
+    is_new = new_positions >= 0
+    for key, group in group_by_key(keys[is_new], new_positions[is_new]).items():
+        pair_positions.setdefault(key, []).extend(group)
+    return changed
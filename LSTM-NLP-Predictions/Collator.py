@@ -1,11 +1,10 @@
-import torch
 from typing import List
 from torch.nn.utils.rnn import pad_sequence
 from torch import Tensor
 
 class Collator:
     """
-    Класс Collator используется для дополнения (padding) списков разной длины
+    Класс Collator используется для дополнения (padding) тензоров разной длины
     до одинаковой длины с использованием заданного значения padding_value.
 
     Аргументы:
@@ -22,9 +21,7 @@ class Collator:
             padding_value (int): Значение для padding.
         """
 
-    def __call__(self, data: List[List[int]]) -> Tensor:
-        data = [torch.tensor(x, dtype=torch.long) for x in data]
-        data = pad_sequence(data, padding_value=self.padding_value)
-        return data.T
+    def __call__(self, data: List[Tensor]) -> Tensor:
+        return pad_sequence(data, batch_first=True, padding_value=self.padding_value)
 
 
@@ -0,0 +1,68 @@
+import numpy as np
+import torch
+from typing import Iterator, List
+from torch.utils.data import Sampler
+
+
+class LengthBucketSampler(Sampler[List[int]]):
+    """
+    Класс LengthBucketSampler формирует батчи из последовательностей близкой длины, чтобы Collator
+    добавлял меньше токенов заполнения (padding), на которые LSTM тратит вычисления впустую.
+
+    Индексы перемешиваются, делятся на мегабатчи по batch_size * bucket_size_multiplier элементов,
+    внутри мегабатча сортируются по длине и нарезаются на батчи; порядок батчей затем перемешивается.
+
+    Аргументы:
+        lengths (np.ndarray): Длины последовательностей набора данных.
+        batch_size (int): Размер батча.
+        shuffle (bool, необязательный): Перемешивать ли данные на каждой эпохе. По умолчанию True.
+        drop_last (bool, необязательный): Отбрасывать ли неполные батчи. По умолчанию False.
+        bucket_size_multiplier (int, необязательный): Во сколько раз мегабатч больше батча. По умолчанию 100.
+
+    Методы:
+        __iter__() -> Iterator[List[int]]:
+            Возвращает батчи индексов для одной эпохи.
+        __len__() -> int:
+            Возвращает количество батчей в эпохе.
+    """
+    def __init__(
+            self,
+            lengths: np.ndarray,
+            batch_size: int,
+            shuffle: bool = True,
+            drop_last: bool = False,
+            bucket_size_multiplier: int = 100
+    ):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.bucket_size_multiplier = bucket_size_multiplier
+
+    def __iter__(self) -> Iterator[List[int]]:
+        n = len(self.lengths)
+        # Перестановки берутся из генератора torch, чтобы torch.manual_seed делал порядок воспроизводимым
+        indices = torch.randperm(n).numpy() if self.shuffle else np.arange(n)
+        megabatch_size = self.batch_size * self.bucket_size_multiplier
+
+        batches = []
+        for start in range(0, n, megabatch_size):
+            megabatch = indices[start:start + megabatch_size]
+            megabatch = megabatch[np.argsort(self.lengths[megabatch], kind='stable')]
+            for batch_start in range(0, len(megabatch), self.batch_size):
+                batch = megabatch[batch_start:batch_start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+
+        order = torch.randperm(len(batches)).tolist() if self.shuffle else range(len(batches))
+        for i in order:
+            yield batches[i].tolist()
+
+    def __len__(self) -> int:
+        n = len(self.lengths)
+        megabatch_size = self.batch_size * self.bucket_size_multiplier
+        n_full, rest = divmod(n, megabatch_size)
+        batches_per_megabatch = megabatch_size // self.batch_size
+        if self.drop_last:
+            return n_full * batches_per_megabatch + rest // self.batch_size
+        return n_full * batches_per_megabatch + (rest + self.batch_size - 1) // self.batch_size
@@ -27,7 +27,7 @@ torch.manual_seed(42)
 np.random.seed(42)
 random.seed(42)
 
-model = Model(tokenizer.get_vocab_size(), emb_size=128, hidden_size=256, num_layers=2, dropout=0.1)
+model = Model(tokenizer.get_vocab_size(), emb_size=256, hidden_size=256, num_layers=2, dropout=0.1)
 
 trainer = Trainer(
         model=model,
@@ -1,5 +1,6 @@
 import torch.nn as nn
 import torch
+import torch.nn.functional as F
 from typing import Optional, Tuple
 from torch import Tensor
 
@@ -15,10 +16,17 @@ class Model(nn.Module):
         num_layers (int, необязательный): Количество слоев в LSTM. По умолчанию 1.
         hidden_size (int, необязательный): Размерность скрытого состояния LSTM. По умолчанию 256.
         dropout (float, необязательный): Вероятность отключения нейронов (dropout) между слоями LSTM. По умолчанию 0.0.
+        tie_weights (bool, необязательный): Использовать матрицу эмбеддингов как матрицу весов выходного слоя.
+            Если emb_size не совпадает с hidden_size, перед выходным слоем добавляется проекция в emb_size.
+            По умолчанию True.
+        sparse (bool, необязательный): Вычислять разреженный градиент эмбеддингов: обновляются только строки
+            токенов, встретившихся в батче (оптимизатор должен поддерживать разреженные градиенты, например
+            torch.optim.SparseAdam). Несовместим с tie_weights, так как выходной слой даёт плотный градиент
+            по всей матрице. По умолчанию False.
 
     Методы:
-        forward(x, hx=None) -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
-            Проводит прямое распространение через сеть.
+        forward(x, hx=None, targets=None, ignore_index=-100) -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
+            Проводит прямое распространение через сеть; если заданы targets, возвращает потери вместо логитов.
     """
     def __init__(
             self,
@@ -26,7 +34,9 @@ class Model(nn.Module):
             emb_size: int = 128,
             num_layers: int = 1,
             hidden_size: int = 256,
-            dropout: float = 0.0
+            dropout: float = 0.0,
+            tie_weights: bool = True,
+            sparse: bool = False
     ):
         super().__init__()
         self.vocab_size = vocab_size
@@ -34,14 +44,29 @@ class Model(nn.Module):
         self.num_layers = num_layers
         self.hidden_size = hidden_size
         self.dropout = dropout
-        self.embeddings = nn.Embedding(self.vocab_size, self.emb_size)
-        self.lstm = nn.LSTM(self.emb_size, self.hidden_size, self.num_layers, dropout=self.dropout)
-        self.logits = nn.Linear(self.hidden_size, self.vocab_size)
+        self.tie_weights = tie_weights
+        self.sparse = sparse
+        if self.tie_weights and self.sparse:
+            raise ValueError('sparse embeddings cannot be used with tie_weights=True')
+        self.embeddings = nn.Embedding(self.vocab_size, self.emb_size, sparse=self.sparse)
+        self.lstm = nn.LSTM(self.emb_size, self.hidden_size, self.num_layers, dropout=self.dropout, batch_first=True)
+        self.projection = None
+        if self.tie_weights:
+            # Общая матрица [vocab_size, emb_size] для входа и выхода: вдвое меньше параметров
+            # и вдвое меньше данных, читаемых выходным слоем
+            if self.emb_size != self.hidden_size:
+                self.projection = nn.Linear(self.hidden_size, self.emb_size, bias=False)
+            self.logits = nn.Linear(self.emb_size, self.vocab_size)
+            self.logits.weight = self.embeddings.weight
+        else:
+            self.logits = nn.Linear(self.hidden_size, self.vocab_size)
 
     def forward(
             self,
             x: Tensor,
-            hx: Optional[Tuple[Tensor, Tensor]] = None
+            hx: Optional[Tuple[Tensor, Tensor]] = None,
+            targets: Optional[Tensor] = None,
+            ignore_index: int = -100
     ) -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
         """
         Проводит прямое распространение через сеть.
@@ -49,16 +74,35 @@ class Model(nn.Module):
         Аргументы:
             x (Tensor): Входные данные (индексы слов) размером (batch_size, seq_len).
             hx (Optional[Tuple[Tensor, Tensor]]): Начальные скрытые состояния (h_n, c_n) для LSTM. По умолчанию None.
+            targets (Optional[Tensor]): Целевые индексы размером (batch_size, seq_len). Если заданы, выходной слой
+                применяется только к позициям, где цель не равна ignore_index, и возвращается кросс-энтропия.
+                По умолчанию None.
+            ignore_index (int): Индекс цели, позиции с которым не участвуют в потерях (обычно pad_token_id).
+                По умолчанию -100.
 
         Возвращает:
             Tuple[Tensor, Tuple[Tensor, Tensor]]:
-                - Логиты (предсказания для каждого слова в последовательности) размером (batch_size, seq_len, vocab_size).
+                - Логиты (предсказания для каждого слова в последовательности) размером (batch_size, seq_len, vocab_size)
+                  или, если заданы targets, среднее значение потерь (скаляр FP32) по незамаскированным позициям.
                 - Пара скрытых состояний (h_n, c_n), где h_n и c_n — это последние скрытые и клеточные состояния LSTM.
         """
         embedded = self.embeddings(x)  # Размерность: (batch_size, seq_len, emb_size)
 
         lstm_out, (h_n, c_n) = self.lstm(embedded, hx)  # lstm_out размерностью: (batch_size, seq_len, hidden_size)
 
+        if self.projection is not None:
+            lstm_out = self.projection(lstm_out)  # Размерность: (batch_size, seq_len, emb_size)
+
+        if targets is not None:
+            # Выходной слой и softmax по словарю считаются только для позиций без padding
+            targets = targets.reshape(-1)
+            mask = targets != ignore_index
+            lstm_flat = lstm_out.reshape(-1, lstm_out.size(-1))[mask]  # Размерность: (n_tokens, emb_size)
+            logits = self.logits(lstm_flat)  # Размерность: (n_tokens, vocab_size)
+            # Потери считаются в FP32 даже при прямом проходе в BF16: log_softmax по словарю чувствителен к точности
+            loss = F.cross_entropy(logits.float(), targets[mask])
+            return loss, (h_n, c_n)
+
         logits = self.logits(lstm_out)  # Размерность: (batch_size, seq_len, vocab_size)
 
         return logits, (h_n, c_n)
@@ -1,5 +1,8 @@
+from itertools import chain
 from typing import List, Optional
-from tqdm import tqdm
+import numpy as np
+import torch
+from torch import Tensor
 from torch.utils.data import Dataset
 from .ByteTokenizer import ByteTokenizer
 class MyDataset(Dataset):
@@ -10,8 +13,12 @@ class MyDataset(Dataset):
     ----------
     max_length : Optional[int]
         Максимальная длина последовательности токенов (по умолчанию None, что означает отсутствие ограничения).
-    data : List[List[int]]
-        Список последовательностей токенов для каждого текста.
+    flat : np.ndarray
+        Последовательности токенов всех текстов, записанные подряд в один массив np.int32.
+    offsets : np.ndarray
+        Границы последовательностей: i-я последовательность занимает flat[offsets[i]:offsets[i + 1]] (np.int64).
+    lengths : np.ndarray
+        Длины последовательностей после обрезки до max_length (np.int32), нужны для группировки батчей по длине.
 
     Параметры:
     ----------
@@ -24,7 +31,7 @@ class MyDataset(Dataset):
 
     Методы:
     -------
-    __getitem__(idx: int) -> List[int]
+    __getitem__(idx: int) -> Tensor
         Возвращает последовательность токенов для текста по индексу, обрезанную до max_length.
     __len__() -> int
         Возвращает количество текстов в наборе данных
@@ -32,14 +39,22 @@ class MyDataset(Dataset):
     """
     def __init__(self, texts: List[str], tokenizer: ByteTokenizer, max_length: Optional[int] = None):
         self.max_length = max_length
-        self.data = []
-        for text in tqdm(texts):
-            token_ids = [tokenizer.bos_token]
-            token_ids += tokenizer.encode(text)
-            token_ids += [tokenizer.eos_token]
-            self.data.append(token_ids)
-
-    def __getitem__(self, idx: int) -> List[int]:
+        encoded = tokenizer.encode_batch(texts)
+        # Все последовательности хранятся одним массивом с границами: без отдельного объекта
+        # на каждую последовательность и с последовательным расположением в памяти
+        lengths = np.fromiter((len(ids) + 2 for ids in encoded), dtype=np.int64, count=len(encoded))
+        self.offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        self.flat = np.fromiter(
+            chain.from_iterable(chain((tokenizer.bos_token_id,), ids, (tokenizer.eos_token_id,)) for ids in encoded),
+            dtype=np.int32,
+            count=int(self.offsets[-1])
+        )
+        lengths = np.diff(self.offsets)
+        if self.max_length is not None:
+            lengths = np.minimum(lengths, self.max_length)
+        self.lengths = lengths.astype(np.int32)
+
+    def __getitem__(self, idx: int) -> Tensor:
         """
         Возвращает последовательность токенов для текста по индексу, обрезанную до max_length.
 
@@ -50,11 +65,14 @@ class MyDataset(Dataset):
 
         Возвращает:
         -----------
-        List[int]
-            Усеченный список номеров токенов
+        Tensor
+            Усеченный тензор номеров токенов (torch.long), готовый для Collator
         """
-        return self.data[idx][:self.max_length]
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        if self.max_length is not None:
+            end = min(end, start + self.max_length)
+        return torch.from_numpy(self.flat[start:end]).long()
 
     def __len__(self) -> int:
         """Возвращает количество текстов в наборе данных."""
-        return len(self.data)
+        return len(self.offsets) - 1
@@ -6,6 +6,7 @@ from torch.utils.data import DataLoader, Dataset
 from tqdm import tqdm
 from sklearn.model_selection import train_test_split
 from .Model import Model
+from .LengthBucketSampler import LengthBucketSampler
 
 
 class Trainer:
@@ -21,21 +22,30 @@ class Trainer:
         train_batch_size (int, по умолчанию 1): Размер батча для обучения.
         eval_batch_size (int, по умолчанию 1): Размер батча для оценки.
         eval_steps (Optional[int], по умолчанию None): Шаги между оценками.
-        collator (Optional[Callable[[List[List[int]]], Tensor]], по умолчанию None): Функция для подготовки батча.
-        ignore_index (int, по умолчанию -100): Индекс для игнорирования в функции потерь.
+        collator (Optional[Callable[[List[Tensor]], Tensor]], по умолчанию None): Функция для подготовки батча.
+        ignore_index (int, по умолчанию -100): Индекс для игнорирования в функции потерь (передаётся в model.forward).
+        bucket_by_length (bool, по умолчанию True): Собирать обучающие батчи из последовательностей близкой длины
+            (LengthBucketSampler), если у train_dataset есть атрибут lengths.
+        amp_dtype (Optional[torch.dtype], по умолчанию torch.bfloat16): Тип данных для прямого прохода под
+            torch.autocast (смешанная точность). None отключает autocast. BF16 не требует масштабирования
+            потерь, в отличие от FP16; на GPU без поддержки BF16 autocast отключается.
 
     Атрибуты:
         model (Model): Модель, которая обучается.
-        loss_func (nn.CrossEntropyLoss): Функция потерь.
-        optimizer (torch.optim.Adam): Оптимизатор для обучения.
+        ignore_index (int): Индекс целей, не участвующих в потерях; передаётся в model.forward.
+        device (torch.device): Устройство, на котором находится модель; батчи переносятся на него.
+        optimizer (torch.optim.Adam): Оптимизатор для параметров с плотными градиентами.
+        sparse_optimizer (Optional[torch.optim.SparseAdam]): Оптимизатор для эмбеддингов с разреженными
+            градиентами (nn.Embedding(sparse=True)); None, если таких эмбеддингов в модели нет.
         train_loader (DataLoader): Загрузчик данных для обучения.
         eval_loader (DataLoader): Загрузчик данных для оценки.
         n_epochs (int): Количество эпох.
         eval_steps (Optional[int]): Шаги между оценками.
+        amp_dtype (Optional[torch.dtype]): Тип данных autocast или None, если прямой проход выполняется в FP32.
 
     Методы:
-        calc_loss(logits: Tensor, y: Tensor) -> Tensor:
-            Вычисляет потери по логитам и целевым меткам.
+        autocast() -> torch.autocast:
+            Возвращает контекст смешанной точности для прямого прохода.
 
         train() -> None:
             Запускает процесс обучения модели.
@@ -53,43 +63,68 @@ class Trainer:
             train_batch_size: int = 1,
             eval_batch_size: int = 1,
             eval_steps: Optional[int] = None,
-            collator: Optional[Callable[[List[List[int]]], Tensor]] = None,
-            ignore_index: int = -100
+            collator: Optional[Callable[[List[Tensor]], Tensor]] = None,
+            ignore_index: int = -100,
+            bucket_by_length: bool = True,
+            amp_dtype: Optional[torch.dtype] = torch.bfloat16
     ):
         self.model = model
-        self.loss_func = nn.CrossEntropyLoss(ignore_index=ignore_index)
-        self.optimizer = torch.optim.Adam(self.model.parameters(), lr=lr)
-        self.train_loader = DataLoader(
-            train_dataset,
-            batch_size=train_batch_size,
-            shuffle=True,
-            drop_last=True,
-            collate_fn=collator
-        )
+        self.ignore_index = ignore_index
+        self.device = next(self.model.parameters()).device
+        # Разреженные эмбеддинги обновляются SparseAdam: он трогает только строки токенов из батча
+        sparse_params = [
+            param
+            for module in self.model.modules()
+            if isinstance(module, nn.Embedding) and module.sparse
+            for param in module.parameters()
+        ]
+        sparse_ids = {id(param) for param in sparse_params}
+        dense_params = [param for param in self.model.parameters() if id(param) not in sparse_ids]
+        self.optimizer = torch.optim.Adam(dense_params, lr=lr)
+        self.sparse_optimizer = torch.optim.SparseAdam(sparse_params, lr=lr) if sparse_params else None
+        lengths = getattr(train_dataset, 'lengths', None)
+        if bucket_by_length and lengths is not None:
+            self.train_loader = DataLoader(
+                train_dataset,
+                batch_sampler=LengthBucketSampler(lengths, train_batch_size, shuffle=True, drop_last=True),
+                collate_fn=collator,
+                pin_memory=self.device.type == 'cuda'
+            )
+        else:
+            self.train_loader = DataLoader(
+                train_dataset,
+                batch_size=train_batch_size,
+                shuffle=True,
+                drop_last=True,
+                collate_fn=collator,
+                pin_memory=self.device.type == 'cuda'
+            )
         self.eval_loader = DataLoader(
             eval_dataset,
             batch_size=eval_batch_size,
             shuffle=False,
             drop_last=True,
-            collate_fn=collator
+            collate_fn=collator,
+            pin_memory=self.device.type == 'cuda'
         )
         self.n_epochs = n_epochs
         self.eval_steps = eval_steps
+        if amp_dtype == torch.bfloat16 and self.device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+            amp_dtype = None
+        self.amp_dtype = amp_dtype
 
-    def calc_loss(self, logits: Tensor, y: Tensor) -> Tensor:
+    def autocast(self) -> torch.autocast:
         """
-        Вычисляет потери (loss) на основе предсказанных логитов и целевых меток.
-
-        Параметры:
-            logits (Tensor): Предсказанные моделью значения (логиты).
-            y (Tensor): Истинные целевые метки.
+        Возвращает контекст torch.autocast для прямого прохода на устройстве модели.
 
         Возвращает:
-            Tensor: Значение потерь.
+            torch.autocast: Контекст смешанной точности; выключен, если amp_dtype равен None.
         """
-        logits = logits.view(-1, logits.size(-1))
-        y = y.view(-1)
-        return self.loss_func(logits, y)
+        return torch.autocast(
+            device_type=self.device.type,
+            dtype=self.amp_dtype,
+            enabled=self.amp_dtype is not None
+        )
 
     def train(self) -> None:
         """
@@ -100,17 +135,22 @@ class Trainer:
         iterations = 0
         for _ in range(self.n_epochs):
             for ids in self.train_loader:
+                ids = ids.to(self.device, non_blocking=True)
                 iterations += 1
                 self.model.train()
                 x = ids[:, :-1]
                 y = ids[:, 1:]
-                logits, _ = self.model(x)
-                loss = self.calc_loss(logits, y)
+                with self.autocast():
+                    loss, _ = self.model(x, targets=y, ignore_index=self.ignore_index)
                 progress_bar.update()
                 progress_bar.set_description(f'epoch={iterations / len(self.train_loader)}, loss={loss.item()}')
                 self.optimizer.zero_grad()
+                if self.sparse_optimizer is not None:
+                    self.sparse_optimizer.zero_grad()
                 loss.backward()
                 self.optimizer.step()
+                if self.sparse_optimizer is not None:
+                    self.sparse_optimizer.step()
                 if self.eval_steps is not None and iterations % self.eval_steps == 0:
                     print(f'epoch={iterations / len(self.train_loader)}, eval_loss={self.evaluate()}')
 
@@ -124,12 +164,13 @@ class Trainer:
         self.model.eval()
         total_loss = 0.0
         for ids in self.eval_loader:
+            ids = ids.to(self.device, non_blocking=True)
             x = ids[:, :-1]
             y = ids[:, 1:]
             with (torch.no_grad()):
 
-                logits, _ = self.model(x)
-                loss = self.calc_loss(logits, y)
+                with self.autocast():
+                    loss, _ = self.model(x, targets=y, ignore_index=self.ignore_index)
                 total_loss += loss.item() / len(self.eval_loader)
         return total_loss
 
@@ -0,0 +1,153 @@
+"""
+Компилируемые ядра обучения BPE.
+
+Ядра работают с корпусом, склеенным в один массив np.int32 (см. build_linked_list в ByteTokenizer),
+и компилируются Numba в машинный код без упаковки чисел в объекты Python. Если Numba не установлена,
+те же функции выполняются как обычный Python-код, а флаг NUMBA_AVAILABLE позволяет вызывающему коду
+выбрать векторизованную реализацию на NumPy там, где она есть.
+
+Ключ пары (a, b) упаковывается в int64 как (a << 32) | b и распаковывается функцией unpack_pair.
+"""
+from typing import Tuple
+
+import numpy as np
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        """Заглушка для numba.njit: возвращает функцию без изменений."""
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+
+
+# Без parallel=True: пул потоков Numba (TBB) не переживает fork, который делает encode_batch,
+# а параллелизм при обучении даёт пул потоков вокруг nogil-ядер
+@njit(cache=True, nogil=True)
+def count_pairs_nb(ids_flat: np.ndarray, offsets: np.ndarray, weights: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Считает взвешенные частоты пар соседних элементов в склеенном корпусе.
+
+    Ключи пар собираются по последовательностям, после чего сортируются и сворачиваются в частоты.
+
+    Параметры:
+    ----------
+    ids_flat : np.ndarray
+        Склеенный массив идентификаторов всех последовательностей (np.int32).
+    offsets : np.ndarray
+        Границы последовательностей: i-я последовательность занимает ids_flat[offsets[i]:offsets[i + 1]] (np.int64).
+    weights : np.ndarray
+        Вес каждой последовательности (np.int64).
+
+    Возвращает:
+    -----------
+    Tuple[np.ndarray, np.ndarray]
+        Отсортированные упакованные ключи пар и их взвешенные частоты (np.int64).
+    """
+    n_seq = len(offsets) - 1
+    pair_offsets = np.zeros(n_seq + 1, dtype=np.int64)
+    for i in range(n_seq):
+        pair_offsets[i + 1] = pair_offsets[i] + max(offsets[i + 1] - offsets[i] - 1, 0)
+
+    keys = np.empty(pair_offsets[n_seq], dtype=np.int64)
+    pair_weights = np.empty(pair_offsets[n_seq], dtype=np.int64)
+    for i in range(n_seq):
+        out = pair_offsets[i]
+        for j in range(offsets[i], offsets[i + 1] - 1):
+            keys[out] = (np.int64(ids_flat[j]) << 32) | np.int64(ids_flat[j + 1])
+            pair_weights[out] = weights[i]
+            out += 1
+
+    order = np.argsort(keys, kind='mergesort')
+    unique_keys = np.empty(len(keys), dtype=np.int64)
+    counts = np.zeros(len(keys), dtype=np.int64)
+    n_unique = 0
+    for k in range(len(order)):
+        key = keys[order[k]]
+        if n_unique == 0 or unique_keys[n_unique - 1] != key:
+            unique_keys[n_unique] = key
+            n_unique += 1
+        counts[n_unique - 1] += pair_weights[order[k]]
+    return unique_keys[:n_unique], counts[:n_unique]
+
+
+@njit(cache=True, nogil=True)
+def merge_nb(
+        ids: np.ndarray,
+        prev_pos: np.ndarray,
+        next_pos: np.ndarray,
+        positions: np.ndarray,
+        a: int,
+        b: int,
+        idx: int,
+        position_weights: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Склеивает пару (a, b) в idx в указанных позициях двусвязного списка и записывает журнал изменений частот.
+
+    Для каждого вхождения x a b y в журнал попадают изменения частот (x, a), (x, idx), (b, y), (idx, y)
+    и (a, b) на вес вхождения. Позиции обходятся слева направо, устаревшие пропускаются.
+
+    Параметры:
+    ----------
+    ids : np.ndarray
+        Склеенный массив идентификаторов (np.int32), изменяется на месте.
+    prev_pos : np.ndarray
+        Индексы предыдущих элементов (np.int32), изменяются на месте.
+    next_pos : np.ndarray
+        Индексы следующих элементов (np.int32), изменяются на месте.
+    positions : np.ndarray
+        Отсортированные позиции-кандидаты левого элемента пары (np.int64).
+    a : int
+        Первый элемент пары.
+    b : int
+        Второй элемент пары.
+    idx : int
+        Значение, на которое заменяется найденная пара.
+    position_weights : np.ndarray
+        Вес каждой позиции склеенного массива (np.int64).
+
+    Возвращает:
+    -----------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        Упакованные ключи изменённых пар, изменения их частот и позиции новых пар (-1, если пара не новая).
+    """
+    # На одно вхождение приходится не больше пяти изменений частот
+    keys = np.empty(5 * len(positions), dtype=np.int64)
+    deltas = np.empty(5 * len(positions), dtype=np.int64)
+    new_positions = np.empty(5 * len(positions), dtype=np.int64)
+    m = 0
+    for k in range(len(positions)):
+        pos = positions[k]
+        if ids[pos] != a:
+            continue
+        right = next_pos[pos]
+        if right < 0 or ids[right] != b:
+            continue
+
+        weight = position_weights[pos]
+        left = prev_pos[pos]
+        after = next_pos[right]
+        if left >= 0:
+            x = np.int64(ids[left])
+            keys[m], deltas[m], new_positions[m] = (x << 32) | a, -weight, -1
+            keys[m + 1], deltas[m + 1], new_positions[m + 1] = (x << 32) | idx, weight, left
+            m += 2
+        if after >= 0:
+            y = np.int64(ids[after])
+            keys[m], deltas[m], new_positions[m] = (np.int64(b) << 32) | y, -weight, -1
+            keys[m + 1], deltas[m + 1], new_positions[m + 1] = (np.int64(idx) << 32) | y, weight, pos
+            m += 2
+        keys[m], deltas[m], new_positions[m] = (np.int64(a) << 32) | b, -weight, -1
+        m += 1
+
+        ids[pos] = idx
+        ids[right] = -1
+        next_pos[pos] = after
+        if after >= 0:
+            prev_pos[after] = pos
+    return keys[:m], deltas[:m], new_positions[:m]